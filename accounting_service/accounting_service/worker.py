@@ -4,8 +4,8 @@ from dataclasses import asdict
 
 from celery import Celery
 
-from accounting_service.app_common import settings
-from accounting_service.app_common.messaging import accounting_service_messaging
+from accounting_service.app_common import settings, worker_pool
+from accounting_service.app_common.messaging import accounting_service_messaging, queue_wait
 from accounting_service.app_common.messaging.accounting_service_messaging import \
     authorize_card_message
 
@@ -16,6 +16,14 @@ command_handlers_celery_app = Celery(
     broker=settings.CELERY_BROKER,
     backend=settings.CELERY_RESULT_BACKEND)
 command_handlers_celery_app.conf.task_default_queue = accounting_service_messaging.COMMANDS_QUEUE
+command_handlers_celery_app.conf.worker_concurrency = settings.CELERY_WORKER_CONCURRENCY
+command_handlers_celery_app.conf.result_expires = settings.CELERY_RESULT_EXPIRES
+worker_pool.check_worker_pool()
+# don't let a worker reserve a big batch of commands from the queue:
+#   otherwise they wait in a busy worker while other workers are idle
+command_handlers_celery_app.conf.worker_prefetch_multiplier = 1
+
+queue_wait.log_queue_wait()
 
 
 @command_handlers_celery_app.task(name=authorize_card_message.TASK_NAME)
@@ -0,0 +1,26 @@
+"""
+Caching of command results on the sender side.
+
+Command opts into it by declaring CACHE_POLICY next to its TASK_NAME:
+
+    TASK_NAME = 'consumer_service.verify_consumer_details'
+    CACHE_POLICY = CachePolicy(ttl=60, negative_ttl=10, max_size=10000)
+
+Then sender may reuse result of the same command with the same payload instead of sending it again.
+Only use it for commands without side effects.
+"""
+import dataclasses
+from typing import Tuple, Type
+
+
+@dataclasses.dataclass(frozen=True)
+class CachePolicy:
+    # seconds to keep successful result
+    ttl: int
+    # seconds to keep error raised by command handler (e.g. rejected consumer). 0 disables negative caching
+    negative_ttl: int = 0
+    # errors which mean that command is rejected by handler. Only they are cached:
+    #   other errors (broker or result backend failures, lost workers) are not cached
+    rejection_errors: Tuple[Type[Exception], ...] = ()
+    # max number of cached results, least recently used ones are evicted first
+    max_size: int = 10000
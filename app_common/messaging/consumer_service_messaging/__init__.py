@@ -1,2 +1,4 @@
 COMMANDS_QUEUE = 'consumer_service.commands'
 
+# fanout exchange where consumer service publishes its events
+EVENTS_EXCHANGE = 'consumer_service.events'
@@ -0,0 +1,20 @@
+import dataclasses
+
+import asyncapi
+
+
+EVENT_NAME = 'consumer_service.consumer_details_changed'
+
+
+@dataclasses.dataclass
+class Payload:
+    consumer_id: int
+
+
+message = asyncapi.Message(
+    name=EVENT_NAME,
+    title='Consumer details changed',
+    summary='This event is published when consumer details change, '
+            'so previous verification results of this consumer are not valid anymore',
+    payload=Payload,
+)
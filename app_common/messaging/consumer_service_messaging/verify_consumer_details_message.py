@@ -2,8 +2,14 @@ import dataclasses
 
 import asyncapi
 
+from ..cache_policy import CachePolicy
+
 
 TASK_NAME = 'consumer_service.verify_consumer_details'
+# verification result may be reused by sender. It's invalidated by "consumer details changed" event
+CACHE_POLICY = CachePolicy(ttl=60, negative_ttl=10, max_size=10000,
+                           # handler raises ValueError when consumer is rejected
+                           rejection_errors=(ValueError,))
 
 
 @dataclasses.dataclass
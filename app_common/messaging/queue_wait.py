@@ -0,0 +1,36 @@
+"""
+Helpers to measure how long a command message waited in a broker queue
+before a worker picked it up.
+
+Sender puts current timestamp into message headers:
+
+    celery_app.send_task(..., headers=queue_wait.sent_at_headers())
+
+and worker logs the difference when task starts:
+
+    queue_wait.log_queue_wait()
+"""
+import logging
+import time
+
+from celery.signals import task_prerun
+
+SENT_AT_HEADER = 'sent_at'
+
+
+def sent_at_headers() -> dict:
+    return {SENT_AT_HEADER: time.time()}
+
+
+def log_queue_wait():
+    """Log queue wait time of every task handled by the current worker."""
+
+    @task_prerun.connect(weak=False)
+    def _log_queue_wait(task_id=None, task=None, **kwargs):
+        sent_at = task.request.get(SENT_AT_HEADER)
+        if sent_at is None:
+            return
+
+        queue = (task.request.delivery_info or {}).get('routing_key')
+        logging.info(f'Queue wait: task={task.name} queue={queue} '
+                     f'wait_ms={(time.time() - sent_at) * 1000:.1f}')
@@ -1,2 +1,5 @@
 COMMANDS_QUEUE = 'restaurant_service.commands'
 
+# compensation commands (like "reject ticket") go to a separate queue
+# so they're never stuck behind a backlog of new forward commands
+COMPENSATIONS_QUEUE = 'restaurant_service.compensations'
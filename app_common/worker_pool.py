@@ -0,0 +1,30 @@
+"""
+Checks that command handler worker runs in the execution pool configured with CELERY_WORKER_POOL setting.
+
+Pool itself is chosen with "-P" worker option, so gevent / eventlet monkey patching is done early enough.
+This check makes sure it matches settings:
+
+    worker_pool.check_worker_pool()
+"""
+import logging
+
+from celery.signals import worker_init
+
+from . import settings
+
+WORKER_POOLS = ('prefork', 'threads', 'solo', 'gevent', 'eventlet')
+
+
+def check_worker_pool():
+    if settings.CELERY_WORKER_POOL not in WORKER_POOLS:
+        raise ValueError(f'Unknown CELERY_WORKER_POOL = {settings.CELERY_WORKER_POOL!r}, '
+                         f'expected one of {", ".join(WORKER_POOLS)}')
+
+    @worker_init.connect(weak=False)
+    def _check_running_pool(sender=None, **kwargs):
+        # at this point, pool is still a name given with "-P" option (or Celery default)
+        running_pool = sender.pool_cls
+        if isinstance(running_pool, str) and running_pool != settings.CELERY_WORKER_POOL:
+            logging.warning(f'Worker runs in "{running_pool}" pool, '
+                            f'but CELERY_WORKER_POOL setting is "{settings.CELERY_WORKER_POOL}". '
+                            f'Pass "-P {settings.CELERY_WORKER_POOL}" to the worker')
@@ -3,20 +3,23 @@ import asyncapi
 from consumer_service.app_common.messaging import consumer_service_messaging
 from consumer_service.app_common.messaging.asyncapi_utils import fake_asyncapi_servers
 from consumer_service.app_common.messaging.consumer_service_messaging import \
-    verify_consumer_details_message
+    verify_consumer_details_message, consumer_details_changed_event
 from consumer_service.app_common.messaging.asyncapi_utils import message_to_channel, message_to_component
 
 spec = asyncapi.Specification(
     info=asyncapi.Info(
         title='Consumer service', version='1.0.0',
-        description=f'Takes command messages from "{consumer_service_messaging.COMMANDS_QUEUE}" queue',
+        description=f'Takes command messages from "{consumer_service_messaging.COMMANDS_QUEUE}" queue. \n'
+                    f'Publishes events to "{consumer_service_messaging.EVENTS_EXCHANGE}" fanout exchange',
     ),
     channels=dict([
-        message_to_channel(verify_consumer_details_message.message)
+        message_to_channel(verify_consumer_details_message.message),
+        message_to_channel(consumer_details_changed_event.message, publish_made_first=True),
     ]),
     # all messages met in specification
     components=asyncapi.Components(messages=dict([
-        message_to_component(verify_consumer_details_message.message)
+        message_to_component(verify_consumer_details_message.message),
+        message_to_component(consumer_details_changed_event.message),
     ])),
     servers=fake_asyncapi_servers,
 )
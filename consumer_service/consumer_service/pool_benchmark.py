@@ -0,0 +1,73 @@
+"""
+Compares throughput of consumer_service worker execution pools
+with a mix of slow and fast "verify consumer details" commands.
+
+Start the worker with a pool you want to measure, e.g.
+
+    export CELERY_WORKER_POOL=prefork
+    PYTHONPATH=. celery -A consumer_service.worker worker -P $CELERY_WORKER_POOL
+
+    export CELERY_WORKER_POOL=gevent CELERY_WORKER_CONCURRENCY=1000
+    PYTHONPATH=. celery -A consumer_service.worker worker -P $CELERY_WORKER_POOL
+
+then run
+
+    PYTHONPATH=. python consumer_service/pool_benchmark.py --messages 1000 --slow-ratio 0.1
+"""
+import argparse
+import random
+import time
+from dataclasses import asdict
+
+from celery import Celery
+
+from consumer_service.app_common import settings
+from consumer_service.app_common.messaging import consumer_service_messaging
+from consumer_service.app_common.messaging.consumer_service_messaging import \
+    verify_consumer_details_message
+
+# see consumer_service.worker: ids 50-59 take 7 seconds to verify, ids 60+ are verified immediately
+SLOW_CONSUMER_IDS = range(50, 60)
+FAST_CONSUMER_IDS = range(60, 100)
+
+celery_app = Celery('pool_benchmark',
+                    broker=settings.CELERY_BROKER,
+                    backend=settings.CELERY_RESULT_BACKEND)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--slow-ratio', type=float, default=0.1,
+                        help='share of messages that take 7 seconds to handle')
+    parser.add_argument('--timeout', type=int, default=600)
+    args = parser.parse_args()
+
+    consumer_ids = [random.choice(SLOW_CONSUMER_IDS) if random.random() < args.slow_ratio
+                    else random.choice(FAST_CONSUMER_IDS)
+                    for _ in range(args.messages)]
+
+    started_at = time.time()
+    pending = [
+        celery_app.send_task(
+            verify_consumer_details_message.TASK_NAME,
+            args=[asdict(verify_consumer_details_message.Payload(consumer_id=consumer_id))],
+            queue=consumer_service_messaging.COMMANDS_QUEUE)
+        for consumer_id in consumer_ids
+    ]
+
+    deadline = started_at + args.timeout
+    while pending and time.time() < deadline:
+        pending = [task_result for task_result in pending if not task_result.ready()]
+        time.sleep(0.1)
+    elapsed = time.time() - started_at
+
+    finished = args.messages - len(pending)
+    slow = sum(consumer_id in SLOW_CONSUMER_IDS for consumer_id in consumer_ids)
+    print(f'{finished}/{args.messages} messages ({slow} slow) handled in {elapsed:.1f}s, '
+          f'throughput={finished / elapsed:.1f} messages/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,15 @@
 import logging
 import random
 import time
+from dataclasses import asdict
 
 from celery import Celery
+from kombu import Exchange
 
-from consumer_service.app_common import settings
+from consumer_service.app_common import settings, worker_pool
 from consumer_service.app_common.messaging.consumer_service_messaging import \
-    verify_consumer_details_message
-from consumer_service.app_common.messaging import consumer_service_messaging
+    verify_consumer_details_message, consumer_details_changed_event
+from consumer_service.app_common.messaging import consumer_service_messaging, queue_wait
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -16,6 +18,32 @@ command_handlers_celery_app = Celery(
     broker=settings.CELERY_BROKER,
     backend=settings.CELERY_RESULT_BACKEND)
 command_handlers_celery_app.conf.task_default_queue = consumer_service_messaging.COMMANDS_QUEUE
+command_handlers_celery_app.conf.worker_concurrency = settings.CELERY_WORKER_CONCURRENCY
+command_handlers_celery_app.conf.result_expires = settings.CELERY_RESULT_EXPIRES
+worker_pool.check_worker_pool()
+# don't let a worker reserve a big batch of commands from the queue:
+#   otherwise they wait in a busy worker while other workers are idle
+command_handlers_celery_app.conf.worker_prefetch_multiplier = 1
+
+queue_wait.log_queue_wait()
+
+events_exchange = Exchange(consumer_service_messaging.EVENTS_EXCHANGE, type='fanout')
+
+
+def publish_consumer_details_changed(consumer_id: int):
+    """
+    Should be called when consumer details change.
+    Subscribers (e.g. order_service cache of verification results) drop what they know about this consumer.
+    """
+    with command_handlers_celery_app.producer_or_acquire() as producer:
+        producer.publish(
+            asdict(consumer_details_changed_event.Payload(consumer_id=consumer_id)),
+            exchange=events_exchange,
+            declare=[events_exchange],
+            headers={'event': consumer_details_changed_event.EVENT_NAME},
+            serializer='json',
+        )
+    logging.info(f'Consumer #{consumer_id} details changed event published')
 
 
 @command_handlers_celery_app.task(name=verify_consumer_details_message.TASK_NAME)
@@ -0,0 +1,125 @@
+"""
+Admission control on saga creation.
+
+Instead of starting any number of sagas and ending up with mass timeouts and compensation storms
+when downstream services are overloaded, order_service rejects new sagas fast when it's over budget:
+ * too many sagas are in flight in total
+ * too many sagas are waiting for a response from the same downstream queue
+ * (optionally) too many messages are waiting in a downstream broker queue
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Optional
+
+from order_service import metrics
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(self,
+                 downstream_queues: Iterable[str],
+                 max_in_flight: int,
+                 max_in_flight_per_queue: int,
+                 retry_after: int,
+                 max_queue_depth: int = 0,
+                 queue_depth_fn: Optional[Callable[[str], int]] = None,
+                 queue_depth_check_interval: float = 1):
+        self.downstream_queues = list(downstream_queues)
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_queue = max_in_flight_per_queue
+        self.retry_after = retry_after
+        self.max_queue_depth = max_queue_depth
+        self.queue_depth_fn = queue_depth_fn
+        self.queue_depth_check_interval = queue_depth_check_interval
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiting_on = {}  # saga id -> queue which saga waits a response from
+        # queue -> (checked at, depth). Guarded by its own lock, never held during broker I/O
+        self._queue_depths = {}
+        self._queue_depths_lock = threading.Lock()
+
+    @contextmanager
+    def admit(self):
+        """
+        Reserve a place for a saga. Raises AdmissionRejected if over budget.
+        The place is released when the block exits.
+        """
+        # broker may be slow exactly during overload, so depths are sampled without holding the main lock:
+        #   running sagas calling waiting_on() / finished() shouldn't wait for broker I/O
+        queue_depths = self._sample_queue_depths()
+
+        with self._lock:
+            reason = self._rejection_reason(queue_depths)
+            if reason is None:
+                self._in_flight += 1
+                metrics.set_gauge('sagas_in_flight', self._in_flight)
+
+        if reason is not None:
+            logging.warning(f'Saga rejected by admission control: {reason}')
+            metrics.inc('saga_admission_rejected_total', reason=reason.split(':')[0])
+            raise AdmissionRejected(reason, self.retry_after)
+
+        metrics.inc('saga_admission_accepted_total')
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                metrics.set_gauge('sagas_in_flight', self._in_flight)
+
+    def waiting_on(self, saga_id, queue: str):
+        """Mark that saga has sent a command to a queue and waits for the response."""
+        with self._lock:
+            self._waiting_on[saga_id] = queue
+
+    def finished(self, saga_id):
+        with self._lock:
+            self._waiting_on.pop(saga_id, None)
+
+    def _rejection_reason(self, queue_depths: Dict[str, int]) -> Optional[str]:
+        if self._in_flight >= self.max_in_flight:
+            return f'max_in_flight: {self._in_flight} sagas in flight'
+
+        waiting_per_queue = Counter(self._waiting_on.values())
+        for queue in self.downstream_queues:
+            if waiting_per_queue[queue] >= self.max_in_flight_per_queue:
+                return f'max_in_flight_per_queue: {waiting_per_queue[queue]} sagas wait on {queue}'
+
+        for queue, depth in queue_depths.items():
+            if depth >= self.max_queue_depth:
+                return f'max_queue_depth: {depth} messages in {queue}'
+
+        return None
+
+    def _sample_queue_depths(self) -> Dict[str, int]:
+        if not (self.max_queue_depth and self.queue_depth_fn):
+            return {}
+        return {queue: self._queue_depth(queue) for queue in self.downstream_queues}
+
+    def _queue_depth(self, queue: str) -> int:
+        with self._queue_depths_lock:
+            checked_at, depth = self._queue_depths.get(queue, (0, 0))
+            if time.monotonic() - checked_at < self.queue_depth_check_interval:
+                return depth
+            # other threads keep using the previous value while this one asks the broker
+            self._queue_depths[queue] = (time.monotonic(), depth)
+
+        try:
+            depth = self.queue_depth_fn(queue)
+        except Exception as e:
+            # broker is unavailable, don't reject sagas because of monitoring failure
+            logging.warning(f'Failed to get depth of {queue} queue: {e}')
+
+        with self._queue_depths_lock:
+            self._queue_depths[queue] = (time.monotonic(), depth)
+        return depth
@@ -1,26 +1,35 @@
 import enum
+import json
 import logging
 import os
 import random
+import time
 import traceback
+import zlib
+from datetime import datetime
 
 import mimesis  # for fake data generation
 from dataclasses import asdict
 
+from amqp.exceptions import NotFound
 from celery import Celery
 from celery.exceptions import TimeoutError as CeleryTimeoutError
-from flask import Flask
+from flask import Flask, jsonify, abort
 from flask_sqlalchemy import SQLAlchemy
 from saga import SagaBuilder, SagaError
+from sqlalchemy import inspect, text
 from sqlalchemy_mixins import AllFeaturesMixin
 
+from order_service import metrics
+from order_service.admission import AdmissionController, AdmissionRejected
+from order_service.result_cache import CommandResultCache, EventsListener
 from order_service.app_common import settings
 from order_service.app_common.messaging.accounting_service_messaging import \
     authorize_card_message
 from order_service.app_common.messaging.consumer_service_messaging import \
-    verify_consumer_details_message
+    verify_consumer_details_message, consumer_details_changed_event
 from order_service.app_common.messaging import consumer_service_messaging, \
-    accounting_service_messaging, restaurant_service_messaging
+    accounting_service_messaging, restaurant_service_messaging, queue_wait
 from order_service.app_common.messaging.restaurant_service_messaging import \
     create_ticket_message, reject_ticket_message, approve_ticket_message
 
@@ -33,12 +42,54 @@ celery_app = Celery('my_celery_app',
 app = Flask(__name__)
 
 current_dir = os.path.abspath(os.path.dirname(__file__))
-app.config[
-    'SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{current_dir}/order_service.sqlite"
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv(
+    'ORDER_SERVICE_DATABASE_URI', f"sqlite:///{current_dir}/order_service.sqlite")
 
 db = SQLAlchemy(app, session_options={'autocommit': True})
 
 
+def broker_queue_depth(queue):
+    with celery_app.connection_or_acquire() as connection:
+        # short-lived channel: broker closes channel on passive declare of missing queue,
+        #   so pooled connection's default channel must not be used for it
+        with connection.channel() as channel:
+            try:
+                return channel.queue_declare(queue=queue, passive=True).message_count
+            except NotFound:
+                # queue isn't declared yet (e.g. its worker hasn't started), nothing is waiting there
+                return 0
+
+
+admission_controller = AdmissionController(
+    downstream_queues=[consumer_service_messaging.COMMANDS_QUEUE,
+                       restaurant_service_messaging.COMMANDS_QUEUE,
+                       restaurant_service_messaging.COMPENSATIONS_QUEUE,
+                       accounting_service_messaging.COMMANDS_QUEUE],
+    max_in_flight=settings.ADMISSION_MAX_IN_FLIGHT_SAGAS,
+    max_in_flight_per_queue=settings.ADMISSION_MAX_IN_FLIGHT_SAGAS_PER_QUEUE,
+    retry_after=settings.ADMISSION_RETRY_AFTER,
+    max_queue_depth=settings.ADMISSION_MAX_QUEUE_DEPTH,
+    queue_depth_fn=broker_queue_depth,
+    queue_depth_check_interval=settings.ADMISSION_QUEUE_DEPTH_CHECK_INTERVAL,
+)
+
+result_cache = CommandResultCache(enabled=settings.COMMAND_RESULT_CACHE_ENABLED)
+
+
+def on_consumer_details_changed(payload: dict):
+    event = consumer_details_changed_event.Payload(**payload)
+    result_cache.invalidate(verify_consumer_details_message,
+                            verify_consumer_details_message.Payload(consumer_id=event.consumer_id))
+    logging.info(f'Cached verification of consumer #{event.consumer_id} invalidated')
+
+
+if result_cache.enabled:
+    EventsListener(celery_app.connection_for_read(),
+                   exchange_name=consumer_service_messaging.EVENTS_EXCHANGE,
+                   handlers={consumer_details_changed_event.EVENT_NAME: on_consumer_details_changed}) \
+        .start_in_background()
+
+
 class OrderStatuses(enum.Enum):
     PENDING_VALIDATION = 'pending_validation'
     APPROVED = 'approved'
@@ -87,19 +138,102 @@ class CreateOrderSagaState(BaseModel):
     id = db.Column(db.Integer, primary_key=True)
     status = db.Column(db.Enum(CreateOrderSagaStatuses),
                        default=CreateOrderSagaStatuses.ORDER_CREATED)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'))
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), index=True)
     last_message_id = db.Column(db.String)
+    # used to find terminal sagas old enough to be archived
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+
+class ArchivedOrder(BaseModel):
+    """
+    Order of terminal (SUCCEEDED / FAILED) saga moved out of hot tables by archival job
+    (see order_service/archival.py). Order, its items and saga state are stored
+    as a single zlib-compressed JSON document.
+    """
+    order_id = db.Column(db.Integer, primary_key=True)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    compressed_data = db.Column(db.LargeBinary)
+
+    @staticmethod
+    def compress(data: dict) -> bytes:
+        return zlib.compress(json.dumps(data).encode())
+
+    @property
+    def data(self) -> dict:
+        return json.loads(zlib.decompress(self.compressed_data))
 
 
 BaseModel.set_session(db.session)
 db.create_all()  # "run migrations"
 
 
+def migrate_existing_tables():
+    """
+    db.create_all() only creates missing tables and doesn't change existing ones,
+    so add columns and indexes that appeared later to DB created by previous versions. It's idempotent.
+    """
+    table = CreateOrderSagaState.__tablename__
+    columns = {column['name'] for column in inspect(db.engine).get_columns(table)}
+    with db.engine.begin() as connection:
+        if 'updated_at' not in columns:
+            connection.execute(text(f'ALTER TABLE {table} ADD COLUMN updated_at DATETIME'))
+            # existing sagas become archivable once they're older than archival threshold from now
+            connection.execute(text(f'UPDATE {table} SET updated_at = CURRENT_TIMESTAMP'))
+        connection.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{table}_updated_at ON {table} (updated_at)'))
+        connection.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{table}_order_id ON {table} (order_id)'))
+
+
+migrate_existing_tables()
+
+
+def saga_state_to_dict(saga_state: CreateOrderSagaState) -> dict:
+    return dict(
+        id=saga_state.id,
+        status=saga_state.status.value,
+        last_message_id=saga_state.last_message_id,
+        updated_at=saga_state.updated_at.isoformat() if saga_state.updated_at else None,
+    )
+
+
+def order_to_dict(order: Order, saga_state: CreateOrderSagaState) -> dict:
+    return dict(
+        id=order.id,
+        status=order.status.value if order.status else None,
+        consumer_id=order.consumer_id,
+        card_id=order.card_id,
+        price=order.price,
+        transaction_id=order.transaction_id,
+        restaurant_ticket_id=order.restaurant_ticket_id,
+        items=[dict(name=item.name, quantity=item.quantity) for item in order.items],
+        saga_state=saga_state_to_dict(saga_state) if saga_state else None,
+    )
+
+
 @app.route('/ping')
 def ping():
     return 'ping response'
 
 
+@app.route('/orders/<int:order_id>')
+def get_order(order_id):
+    # live orders are in hot tables, orders of completed sagas may be already archived
+    order = Order.query.get(order_id)
+    if order:
+        saga_state = CreateOrderSagaState.query.filter_by(order_id=order_id).first()
+        return jsonify(archived=False, **order_to_dict(order, saga_state))
+
+    archived_order = ArchivedOrder.query.get(order_id)
+    if archived_order:
+        return jsonify(archived=True, **archived_order.data)
+
+    abort(404)
+
+
+@app.route('/metrics')
+def metrics_page():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
 BASE_INPUT_DATA = dict(
     items=[
         OrderItem(
@@ -123,14 +257,25 @@ PRICE_THAT_WILL_SUCCEED = 20
 PRICE_THAT_WILL_FAIL = 80
 
 
-def _run_saga(input_data):
-    order = Order.create(**input_data)
+def run_create_order_saga(input_data):
+    """
+    Creates order and runs its CreateOrderSaga.
+    Raises AdmissionRejected if service is overloaded, SagaError if saga failed
+    """
+    with admission_controller.admit():
+        order = Order.create(**input_data)
 
-    # TODO: execute in a separate Celery task
-    try:
+        # TODO: execute in a separate Celery task
         CreateOrderSaga(order).execute()
+
+
+def _run_saga(input_data):
+    try:
+        run_create_order_saga(input_data)
     except SagaError as e:
         return f'Saga failed: {e} \n . See logs for more details'
+    except AdmissionRejected as e:
+        return f'Saga rejected, service is overloaded: {e}', 429, {'Retry-After': str(e.retry_after)}
 
     return 'Saga succeeded'
 
@@ -147,6 +292,7 @@ def welcome_page():
       <li><a href="/run-saga-failing-on-consumer-verification-because-of-timeout">/run-saga-failing-on-consumer-verification-because-of-timeout</a></li>
       <li><a href="/run-saga-failing-on-card-authorization">/run-saga-failing-on-card-authorization</a></li>
     </ul>
+    See <a href="/metrics">/metrics</a> for service metrics.
     '''
 
 
@@ -245,15 +391,31 @@ class CreateOrderSaga:
             logging.error('Closing saga')
             # in real world, we would also report this error somewhere
             raise
+        finally:
+            admission_controller.finished(self.saga_state.id)
 
     def verify_consumer_details(self):
         logging.info(f'Verifying consumer #{self.order.consumer_id} ...')
+        payload = verify_consumer_details_message.Payload(consumer_id=self.order.consumer_id)
+
+        cached = result_cache.get(verify_consumer_details_message, payload)
+        if cached is not None:
+            self.saga_state.update(status=CreateOrderSagaStatuses.VERIFYING_CONSUMER_DETAILS,
+                                   last_message_id=None)
+            # raises cached error if consumer was rejected recently
+            cached.value()
+            logging.info(f'Consumer #{self.order.consumer_id} verified (cached result)')
+            return
+
+        # result isn't cached if consumer details change while command is in flight
+        cache_generation = result_cache.generation()
+        sent_at = time.monotonic()
         task_result = celery_app.send_task(
             verify_consumer_details_message.TASK_NAME,
-            args=[asdict(
-                verify_consumer_details_message.Payload(consumer_id=self.order.consumer_id)
-            )],
-            queue=consumer_service_messaging.COMMANDS_QUEUE)
+            args=[asdict(payload)],
+            queue=consumer_service_messaging.COMMANDS_QUEUE,
+            headers=queue_wait.sent_at_headers())
+        admission_controller.waiting_on(self.saga_state.id, consumer_service_messaging.COMMANDS_QUEUE)
 
         self.saga_state.update(status=CreateOrderSagaStatuses.VERIFYING_CONSUMER_DETAILS,
                                last_message_id=task_result.id)
@@ -262,7 +424,16 @@ class CreateOrderSaga:
         # In case task handler throws exception,
         #   Celery automatically raises exception here by itself
         #   and saga library automatically launches compensations
-        result = task_result.get(timeout=self.TIMEOUT)
+        try:
+            result = task_result.get(timeout=self.TIMEOUT)
+        except Exception as e:
+            # only rejection of consumer is cached (see CACHE_POLICY.rejection_errors),
+            #   timeouts and infrastructure errors are just re-raised
+            result_cache.set_error(verify_consumer_details_message, payload, e,
+                                   time.monotonic() - sent_at, cache_generation)
+            raise
+        result_cache.set_result(verify_consumer_details_message, payload, result,
+                                time.monotonic() - sent_at, cache_generation)
         logging.info(f'result = {result}')
         logging.info(f'Consumer #{self.order.consumer_id} verified')
 
@@ -289,7 +460,9 @@ class CreateOrderSaga:
                     ]
                 )
             )],
-            queue=restaurant_service_messaging.COMMANDS_QUEUE)
+            queue=restaurant_service_messaging.COMMANDS_QUEUE,
+            headers=queue_wait.sent_at_headers())
+        admission_controller.waiting_on(self.saga_state.id, restaurant_service_messaging.COMMANDS_QUEUE)
 
         self.saga_state.update(status=CreateOrderSagaStatuses.CREATING_RESTAURANT_TICKET,
                                last_message_id=task_result.id)
@@ -311,7 +484,9 @@ class CreateOrderSaga:
                     ticket_id=self.order.restaurant_ticket_id
                 )
             )],
-            queue=restaurant_service_messaging.COMMANDS_QUEUE)
+            queue=restaurant_service_messaging.COMPENSATIONS_QUEUE,
+            headers=queue_wait.sent_at_headers())
+        admission_controller.waiting_on(self.saga_state.id, restaurant_service_messaging.COMPENSATIONS_QUEUE)
 
         self.saga_state.update(status=CreateOrderSagaStatuses.REJECTING_RESTAURANT_TICKET,
                                last_message_id=task_result.id)
@@ -328,7 +503,9 @@ class CreateOrderSaga:
                     ticket_id=self.order.restaurant_ticket_id
                 )
             )],
-            queue=restaurant_service_messaging.COMMANDS_QUEUE)
+            queue=restaurant_service_messaging.COMMANDS_QUEUE,
+            headers=queue_wait.sent_at_headers())
+        admission_controller.waiting_on(self.saga_state.id, restaurant_service_messaging.COMMANDS_QUEUE)
 
         self.saga_state.update(status=CreateOrderSagaStatuses.APPROVING_RESTAURANT_TICKET,
                                last_message_id=task_result.id)
@@ -344,7 +521,9 @@ class CreateOrderSaga:
                 authorize_card_message.Payload(card_id=self.order.card_id,
                                                amount=self.order.price)
             )],
-            queue=accounting_service_messaging.COMMANDS_QUEUE)
+            queue=accounting_service_messaging.COMMANDS_QUEUE,
+            headers=queue_wait.sent_at_headers())
+        admission_controller.waiting_on(self.saga_state.id, accounting_service_messaging.COMMANDS_QUEUE)
 
         self.saga_state.update(status=CreateOrderSagaStatuses.AUTHORIZING_CREDIT_CARD,
                                last_message_id=task_result.id)
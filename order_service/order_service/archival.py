@@ -0,0 +1,104 @@
+"""
+Background job moving completed sagas out of hot tables.
+
+Terminal (SUCCEEDED / FAILED) sagas older than a threshold are moved, together with their orders
+and order items, into ArchivedOrder table as compressed documents. So hot tables
+stay bounded, and status queries and recovery scans don't slow down as history grows.
+
+Job works in small batches, each in its own short transaction, so it never holds long locks.
+Archived orders are still available by order id, see /orders/<order_id> endpoint.
+
+Run it next to order_service:
+
+    PYTHONPATH=. python order_service/archival.py
+
+or make a single run:
+
+    PYTHONPATH=. python order_service/archival.py --once
+"""
+import argparse
+import logging
+import time
+from datetime import datetime, timedelta
+
+from order_service.app import db, Order, OrderItem, CreateOrderSagaState, CreateOrderSagaStatuses, \
+    ArchivedOrder, order_to_dict, saga_state_to_dict
+from order_service.app_common import settings
+
+TERMINAL_STATUSES = [CreateOrderSagaStatuses.SUCCEEDED, CreateOrderSagaStatuses.FAILED]
+
+
+def archive_batch(older_than: datetime, batch_size: int) -> int:
+    """Archive single batch of terminal sagas. Returns number of archived sagas."""
+    with db.session.begin():
+        saga_states = CreateOrderSagaState.query \
+            .filter(CreateOrderSagaState.status.in_(TERMINAL_STATUSES),
+                    CreateOrderSagaState.updated_at < older_than,
+                    CreateOrderSagaState.order_id.isnot(None)) \
+            .order_by(CreateOrderSagaState.id) \
+            .limit(batch_size) \
+            .all()
+        if not saga_states:
+            return 0
+
+        order_ids = [saga_state.order_id for saga_state in saga_states]
+        orders = {order.id: order for order in Order.query.filter(Order.id.in_(order_ids))}
+
+        for saga_state in saga_states:
+            order = orders.get(saga_state.order_id)
+            if order is not None:
+                data = order_to_dict(order, saga_state)
+            else:
+                # order itself is already gone, still keep its items and saga state rather than losing them
+                data = dict(
+                    id=saga_state.order_id,
+                    items=[dict(name=item.name, quantity=item.quantity)
+                           for item in OrderItem.query.filter_by(order_id=saga_state.order_id)],
+                    saga_state=saga_state_to_dict(saga_state),
+                )
+            db.session.add(ArchivedOrder(
+                order_id=saga_state.order_id,
+                compressed_data=ArchivedOrder.compress(data)
+            ))
+
+        OrderItem.query.filter(OrderItem.order_id.in_(order_ids)).delete(synchronize_session=False)
+        CreateOrderSagaState.query.filter(CreateOrderSagaState.id.in_([s.id for s in saga_states])) \
+            .delete(synchronize_session=False)
+        Order.query.filter(Order.id.in_(order_ids)).delete(synchronize_session=False)
+
+    # objects are deleted with bulk queries, don't keep them in session identity map
+    db.session.expunge_all()
+    return len(saga_states)
+
+
+def archive_completed_sagas(min_age: int = settings.ARCHIVAL_MIN_AGE,
+                            batch_size: int = settings.ARCHIVAL_BATCH_SIZE) -> int:
+    """Archive all terminal sagas older than min_age seconds batch by batch."""
+    older_than = datetime.utcnow() - timedelta(seconds=min_age)
+    total = 0
+    while True:
+        archived = archive_batch(older_than, batch_size)
+        total += archived
+        if archived < batch_size:
+            break
+
+    logging.info(f'Archival: {total} completed sagas archived, '
+                 f'{CreateOrderSagaState.query.count()} sagas left in hot tables')
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--once', action='store_true', help='make a single run and exit')
+    args = parser.parse_args()
+
+    while True:
+        archive_completed_sagas()
+        if args.once:
+            break
+        time.sleep(settings.ARCHIVAL_INTERVAL)
+
+
+if __name__ == '__main__':
+    main()
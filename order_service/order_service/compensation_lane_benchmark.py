@@ -0,0 +1,107 @@
+"""
+Measures how long compensation commands wait compared to forward commands
+when restaurant_service has a big backlog of forward commands.
+
+It firstly floods "create ticket" commands, then sends a number of "reject ticket" compensations
+mixed with more "create ticket" commands, and reports send-to-result latency for both kinds.
+
+Run it against running RabbitMQ, Redis and restaurant_service workers:
+
+    PYTHONPATH=. python order_service/compensation_lane_benchmark.py --backlog 2000 --probes 50
+"""
+import argparse
+import statistics
+import time
+from dataclasses import asdict
+
+from celery import Celery
+
+from order_service.app_common import settings
+from order_service.app_common.messaging import restaurant_service_messaging, queue_wait
+from order_service.app_common.messaging.restaurant_service_messaging import \
+    create_ticket_message, reject_ticket_message
+
+celery_app = Celery('compensation_lane_benchmark',
+                    broker=settings.CELERY_BROKER,
+                    backend=settings.CELERY_RESULT_BACKEND)
+
+
+def send_create_ticket(order_id):
+    return celery_app.send_task(
+        create_ticket_message.TASK_NAME,
+        args=[asdict(create_ticket_message.Payload(order_id=order_id, customer_id=1, items=[]))],
+        queue=restaurant_service_messaging.COMMANDS_QUEUE,
+        headers=queue_wait.sent_at_headers())
+
+
+def send_reject_ticket(ticket_id):
+    return celery_app.send_task(
+        reject_ticket_message.TASK_NAME,
+        args=[asdict(reject_ticket_message.Payload(ticket_id=ticket_id))],
+        queue=restaurant_service_messaging.COMPENSATIONS_QUEUE,
+        headers=queue_wait.sent_at_headers())
+
+
+def wait_for_latencies(sent_by_kind, timeout):
+    """
+    Wait for results of (sent_at, task_result) pairs grouped by command kind.
+    All kinds are polled together, so latency is recorded as soon as a result is ready.
+    Returns {kind: (latencies in seconds, number of not finished commands)}
+    """
+    pending = {kind: list(sent) for kind, sent in sent_by_kind.items()}
+    latencies = {kind: [] for kind in sent_by_kind}
+    deadline = time.time() + timeout
+    while any(pending.values()) and time.time() < deadline:
+        for kind, sent in pending.items():
+            still_pending = []
+            for sent_at, task_result in sent:
+                if task_result.ready():
+                    latencies[kind].append(time.time() - sent_at)
+                else:
+                    still_pending.append((sent_at, task_result))
+            pending[kind] = still_pending
+        time.sleep(0.05)
+    return {kind: (latencies[kind], len(pending[kind])) for kind in sent_by_kind}
+
+
+def report(title, latencies, not_finished):
+    if not latencies:
+        print(f'{title}: no results ({not_finished} not finished)')
+        return
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if len(latencies) >= 20 else latencies[-1]
+    print(f'{title}: n={len(latencies)} not_finished={not_finished} '
+          f'median={statistics.median(latencies) * 1000:.0f}ms p95={p95 * 1000:.0f}ms '
+          f'max={latencies[-1] * 1000:.0f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backlog', type=int, default=2000,
+                        help='number of forward commands sent before measurement')
+    parser.add_argument('--probes', type=int, default=50,
+                        help='number of measured forward and compensation commands')
+    parser.add_argument('--timeout', type=int, default=300)
+    args = parser.parse_args()
+
+    print(f'Creating backlog of {args.backlog} "create ticket" commands ...')
+    backlog = [send_create_ticket(order_id) for order_id in range(args.backlog)]
+
+    forward, compensations = [], []
+    for i in range(args.probes):
+        forward.append((time.time(), send_create_ticket(order_id=args.backlog + i)))
+        compensations.append((time.time(), send_reject_ticket(ticket_id=i)))
+
+    results = wait_for_latencies({'Compensation commands': compensations,
+                                  'Forward commands': forward},
+                                 args.timeout)
+    for kind, (latencies, not_finished) in results.items():
+        report(kind, latencies, not_finished)
+
+    for task_result in backlog:
+        task_result.forget()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""
+Minimal in-process metrics, exposed by order_service at /metrics
+in Prometheus text format.
+"""
+import threading
+from collections import defaultdict
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def set_gauge(name: str, value: float, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def render() -> str:
+    with _lock:
+        samples = sorted({**_counters, **_gauges}.items())
+
+    lines = []
+    for (name, labels), value in samples:
+        labels_str = ','.join(f'{label}="{label_value}"' for label, label_value in labels)
+        lines.append(f'{name}{{{labels_str}}} {value:g}' if labels_str else f'{name} {value:g}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,92 @@
+"""
+Measures how much result backend (Redis) memory a completed saga leaves behind.
+
+Runs a number of successful sagas against running infrastructure and reports result keys and Redis memory per saga:
+ * right after sagas finish, when all their results are still stored
+ * as memory × lifetime (byte-seconds) of result keys, from TTL of each key
+ * after waiting for --settle seconds, i.e. steady-state footprint once results expire
+   (default is just past CELERY_RESULT_EXPIRES, see app_common/settings.py)
+
+Run it before and after changing expiration of results (CELERY_RESULT_EXPIRES of workers):
+
+    PYTHONPATH=. python order_service/result_backend_memory_benchmark.py --sagas 100
+"""
+import argparse
+import random
+import time
+
+from order_service.app import celery_app, CreateOrderSaga, Order, OrderItem, \
+    CONSUMER_ID_THAT_WILL_SUCCEED, PRICE_THAT_WILL_SUCCEED
+from order_service.app_common import settings
+
+RESULT_KEYS_PATTERN = 'celery-task-meta-*'
+
+
+def result_keys(redis_client):
+    return set(redis_client.scan_iter(match=RESULT_KEYS_PATTERN, count=1000))
+
+
+def result_keys_memory(redis_client, keys):
+    """Returns memory of given result keys and their memory × remaining lifetime"""
+    memory = 0
+    byte_seconds = 0
+    for key in keys:
+        key_memory = redis_client.memory_usage(key) or 0
+        memory += key_memory
+        ttl = redis_client.ttl(key)
+        if ttl == -1:  # key never expires
+            ttl = float('inf')
+        byte_seconds += key_memory * max(ttl, 0)
+    return memory, byte_seconds
+
+
+def print_per_saga(title, sagas, keys, memory, used_memory):
+    print(f'{title}:')
+    print(f'  Result keys per saga: {keys / sagas:.2f}')
+    print(f'  Result keys memory per saga: {memory / sagas:.0f} bytes')
+    print(f'  Redis used memory per saga: {used_memory / sagas:.0f} bytes')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sagas', type=int, default=100)
+    parser.add_argument('--settle', type=float, default=settings.CELERY_RESULT_EXPIRES + 5,
+                        help='seconds to wait after sagas finish before measuring steady-state footprint')
+    args = parser.parse_args()
+
+    redis_client = celery_app.backend.client
+    keys_before = result_keys(redis_client)
+    used_memory_before = redis_client.info('memory')['used_memory']
+
+    for _ in range(args.sagas):
+        order = Order.create(
+            items=[OrderItem(name='pizza', quantity=1)],
+            consumer_id=CONSUMER_ID_THAT_WILL_SUCCEED,
+            price=PRICE_THAT_WILL_SUCCEED,
+            card_id=random.randint(1, 5),
+        )
+        CreateOrderSaga(order).execute()
+
+    # only results of sagas run by benchmark are measured
+    new_keys = result_keys(redis_client) - keys_before
+    keys_memory, byte_seconds = result_keys_memory(redis_client, new_keys)
+    used_memory_after = redis_client.info('memory')['used_memory']
+
+    print(f'Sagas: {args.sagas}')
+    print_per_saga('Right after sagas finished', args.sagas,
+                   len(new_keys), keys_memory, used_memory_after - used_memory_before)
+    print(f'  Result keys memory × lifetime per saga: {byte_seconds / args.sagas:.0f} byte-seconds')
+
+    print(f'Waiting {args.settle:.0f} seconds for results to expire ...')
+    time.sleep(args.settle)
+
+    settled_keys = {key for key in new_keys if redis_client.exists(key)}
+    settled_keys_memory, _ = result_keys_memory(redis_client, settled_keys)
+    used_memory_settled = redis_client.info('memory')['used_memory']
+    print_per_saga(f'Steady state, {args.settle:.0f} seconds later', args.sagas,
+                   len(settled_keys), settled_keys_memory, used_memory_settled - used_memory_before)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""
+Cache of command results in orchestrator.
+
+Some commands (like consumer verification) give the same result for the same payload for a while,
+so there's no need to make a round trip to another service on the critical path of every saga.
+Commands opt into caching with CACHE_POLICY in their message modules
+(see app_common/messaging/cache_policy.py).
+
+    cached = result_cache.get(verify_consumer_details_message, payload)
+    if cached is not None:
+        return cached.value()  # raises cached rejection error if command was rejected
+    generation = result_cache.generation()
+    ...  # send command and wait for its result
+    result_cache.set_result(verify_consumer_details_message, payload, result, round_trip_seconds, generation)
+"""
+import dataclasses
+import itertools
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional, Tuple, Type
+
+from kombu import Exchange, Queue
+from kombu.mixins import ConsumerMixin
+
+from order_service import metrics
+from order_service.app_common.messaging.cache_policy import CachePolicy
+
+
+@dataclasses.dataclass
+class CachedResult:
+    result: object = None
+    # type and args of rejection error rather than error itself:
+    #   raising the same instance again and again would keep growing its traceback
+    error_type: Optional[Type[Exception]] = None
+    error_args: Tuple = ()
+
+    def value(self):
+        if self.error_type is not None:
+            raise self.error_type(*self.error_args)
+        return self.result
+
+
+class TTLCache:
+    """Bounded LRU cache with expiration of each entry"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class CommandResultCache:
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._caches = {}  # task name -> TTLCache
+        # task name -> TTLCache of key -> generation at which key was last invalidated
+        self._invalidations = {}
+        self._generations = itertools.count(1)
+        self._lock = threading.Lock()
+        # average duration of real command round trips, to estimate latency saved by cache hits
+        self._round_trip_seconds = {}
+
+    def _policy(self, message_module) -> Optional[CachePolicy]:
+        if not self.enabled:
+            return None
+        return getattr(message_module, 'CACHE_POLICY', None)
+
+    def _cache(self, message_module, caches=None) -> TTLCache:
+        caches = self._caches if caches is None else caches
+        with self._lock:
+            if message_module.TASK_NAME not in caches:
+                caches[message_module.TASK_NAME] = TTLCache(message_module.CACHE_POLICY.max_size)
+            return caches[message_module.TASK_NAME]
+
+    @staticmethod
+    def _key(payload):
+        return dataclasses.astuple(payload)
+
+    def get(self, message_module, payload) -> Optional[CachedResult]:
+        if not self._policy(message_module):
+            return None
+
+        task_name = message_module.TASK_NAME
+        cached = self._cache(message_module).get(self._key(payload))
+        if cached is None:
+            metrics.inc('command_result_cache_misses_total', task=task_name)
+            return None
+
+        metrics.inc('command_result_cache_hits_total', task=task_name)
+        metrics.inc('command_result_cache_saved_seconds_total',
+                    self._round_trip_seconds.get(task_name, 0), task=task_name)
+        return cached
+
+    def generation(self) -> int:
+        """
+        Take it before sending command and pass to set_result / set_error,
+        so that result isn't stored if payload was invalidated while command was in flight
+        """
+        return next(self._generations)
+
+    def _invalidated_since(self, message_module, payload, generation: int) -> bool:
+        invalidated_at = self._cache(message_module, self._invalidations).get(self._key(payload))
+        return invalidated_at is not None and invalidated_at > generation
+
+    def set_result(self, message_module, payload, result, round_trip_seconds: float, generation: int):
+        policy = self._policy(message_module)
+        if not policy:
+            return
+        self._track_round_trip(message_module.TASK_NAME, round_trip_seconds)
+        if self._invalidated_since(message_module, payload, generation):
+            return
+        self._cache(message_module).set(self._key(payload), CachedResult(result=result), policy.ttl)
+
+    def set_error(self, message_module, payload, error: Exception, round_trip_seconds: float, generation: int):
+        policy = self._policy(message_module)
+        if not policy:
+            return
+        if not isinstance(error, policy.rejection_errors):
+            return
+        self._track_round_trip(message_module.TASK_NAME, round_trip_seconds)
+        if self._invalidated_since(message_module, payload, generation):
+            return
+        if policy.negative_ttl:
+            self._cache(message_module).set(self._key(payload),
+                                            CachedResult(error_type=type(error), error_args=error.args),
+                                            policy.negative_ttl)
+
+    def invalidate(self, message_module, payload):
+        policy = self._policy(message_module)
+        if not policy:
+            return
+        key = self._key(payload)
+        # remembered long enough to outlive any command in flight (they time out way sooner than cache TTL)
+        self._cache(message_module, self._invalidations).set(key, self.generation(), policy.ttl)
+        self._cache(message_module).delete(key)
+        metrics.inc('command_result_cache_invalidations_total', task=message_module.TASK_NAME)
+
+    def _track_round_trip(self, task_name, seconds):
+        # exponential moving average
+        previous = self._round_trip_seconds.get(task_name)
+        self._round_trip_seconds[task_name] = seconds if previous is None else 0.9 * previous + 0.1 * seconds
+
+
+class EventsListener(ConsumerMixin):
+    """
+    Listens to events published to a fanout exchange and calls handler by event name.
+    Each listener has its own temporary queue, so every order_service process gets every event.
+    """
+
+    def __init__(self, connection, exchange_name: str, handlers: dict):
+        self.connection = connection
+        self.exchange = Exchange(exchange_name, type='fanout')
+        self.handlers = handlers
+
+    def get_consumers(self, Consumer, channel):
+        queue = Queue(f'order_service.{self.exchange.name}.{uuid.uuid4().hex}',
+                      exchange=self.exchange, exclusive=True, auto_delete=True)
+        return [Consumer(queues=[queue], callbacks=[self.on_event], accept=['json'])]
+
+    def on_event(self, body, message):
+        event_name = message.headers.get('event')
+        handler = self.handlers.get(event_name)
+        if handler:
+            try:
+                handler(body)
+            except Exception:
+                logging.exception(f'Failed to handle {event_name} event')
+        message.ack()
+
+    def start_in_background(self):
+        threading.Thread(target=self.run, daemon=True).start()
@@ -0,0 +1,495 @@
+"""
+Deterministic simulation of CreateOrderSaga with virtual clock.
+
+Testing timeout path for real means waiting out real delays
+(e.g. 7 seconds in consumer_service against 5 seconds of CreateOrderSaga.TIMEOUT).
+Here, the real CreateOrderSaga (with admission control) and real command handlers of the three workers
+run against an in-memory broker and result store, and share a virtual clock:
+time.sleep, time.monotonic and time.time are patched, so nobody really waits.
+
+Extra latency and failures are injected around the real command handlers per TASK_NAME with TaskProfile.
+Every saga and every handled command runs in its own thread, but only one of them runs at a time,
+switched by the virtual clock, so the same seed gives the same results.
+
+Orders are stored in in-memory SQLite DB (unless ORDER_SERVICE_DATABASE_URI is set),
+admission control limits come from app_common/settings.py like in running order_service.
+Command handlers are imported from the other services, so run it from repository checkout:
+
+    PYTHONPATH=. python order_service/simulation.py --scenario timeouts --sagas 1000
+"""
+import argparse
+import contextlib
+import dataclasses
+import heapq
+import itertools
+import logging
+import math
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from typing import Callable, Dict, List, Optional
+from unittest import mock
+
+from celery.exceptions import TimeoutError as CeleryTimeoutError
+from saga import SagaError
+
+# orders of simulated sagas shouldn't end up in DB of order_service
+os.environ.setdefault('ORDER_SERVICE_DATABASE_URI', 'sqlite://')
+
+from order_service import app
+from order_service.admission import AdmissionRejected
+from order_service.app_common.messaging import consumer_service_messaging, \
+    accounting_service_messaging, restaurant_service_messaging, queue_wait
+from order_service.app_common.messaging.accounting_service_messaging import \
+    authorize_card_message
+from order_service.app_common.messaging.consumer_service_messaging import \
+    verify_consumer_details_message
+from order_service.app_common.messaging.restaurant_service_messaging import \
+    create_ticket_message, reject_ticket_message
+
+REPOSITORY_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+WORKER_SERVICES = ['consumer_service', 'restaurant_service', 'accounting_service']
+
+# latency distributions: functions returning latency in seconds using given random generator
+
+
+def uniform(low: float, high: float):
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal(median: float, sigma: float):
+    return lambda rng: rng.lognormvariate(math.log(median), sigma)
+
+
+FAST = uniform(0.005, 0.05)
+
+
+class InjectedFailure(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class TaskProfile:
+    # time command handler takes on top of the real handler (which may sleep by itself, like consumer_service does)
+    latency: Callable[[random.Random], float] = FAST
+    # probability that handler raises InjectedFailure instead of running the real handler
+    error_rate: float = 0
+
+
+@dataclasses.dataclass
+class WorkerConfig:
+    name: str
+    # like a Celery worker started with "-Q a,b", worker takes messages of its queues in turn, without priority
+    queues: List[str]
+    concurrency: int
+
+
+def default_workers(concurrency: int) -> List[WorkerConfig]:
+    """Workers as they're run in docker-compose.yaml"""
+    return [
+        WorkerConfig('consumer_service_worker',
+                     [consumer_service_messaging.COMMANDS_QUEUE], concurrency),
+        WorkerConfig('restaurant_service_worker',
+                     [restaurant_service_messaging.COMMANDS_QUEUE,
+                      restaurant_service_messaging.COMPENSATIONS_QUEUE], concurrency),
+        WorkerConfig('restaurant_service_compensations_worker',
+                     [restaurant_service_messaging.COMPENSATIONS_QUEUE], concurrency),
+        WorkerConfig('accounting_service_worker',
+                     [accounting_service_messaging.COMMANDS_QUEUE], concurrency),
+    ]
+
+
+def command_handlers() -> Dict[str, Callable]:
+    """Real command handlers (Celery tasks) of the three workers by TASK_NAME"""
+    for service in WORKER_SERVICES:
+        service_root = os.path.join(REPOSITORY_ROOT, service)
+        if service_root not in sys.path:
+            sys.path.append(service_root)
+
+    handlers = {}
+    for service in WORKER_SERVICES:
+        worker = __import__(f'{service}.worker', fromlist=['command_handlers_celery_app'])
+        handlers.update({name: task for name, task in worker.command_handlers_celery_app.tasks.items()
+                         if not name.startswith('celery.')})
+    return handlers
+
+
+class Process:
+    """Thread run by VirtualClock"""
+
+    def __init__(self, target: Callable[[], None]):
+        self.target = target
+        self.thread = None
+        self.resumed = threading.Semaphore(0)
+        self.error = None
+        # descriptions of failed commands by id of exception raised from task_result.get()
+        self.failures = {}
+
+
+class VirtualClock:
+    """
+    Runs scheduled callbacks in order of virtual time.
+    Processes are threads that run only when the clock switches to them, one at a time,
+    and give control back when they sleep or wait for a result.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self._events = []
+        self._sequence = itertools.count()  # keeps order of events scheduled at the same time
+        self._current: Optional[Process] = None
+        self._suspended = threading.Semaphore(0)
+
+    @property
+    def current(self) -> Process:
+        if self._current is None:
+            raise RuntimeError('Not in a process of virtual clock')
+        return self._current
+
+    def call_later(self, delay: float, callback: Callable[[], None]):
+        heapq.heappush(self._events, (self.now + delay, next(self._sequence), callback))
+
+    def spawn(self, target: Callable[[], None], delay: float = 0):
+        self.resume_later(Process(target), delay)
+
+    def resume_later(self, process: Process, delay: float = 0):
+        self.call_later(delay, lambda: self._switch(process))
+
+    def sleep(self, seconds: float):
+        """Replaces time.sleep in processes"""
+        self.resume_later(self.current, seconds)
+        self.suspend()
+
+    def suspend(self):
+        """Gives control back to the clock until current process is resumed"""
+        process = self.current
+        self._suspended.release()
+        process.resumed.acquire()
+
+    def run(self):
+        while self._events:
+            self.now, _, callback = heapq.heappop(self._events)
+            callback()
+
+    def _switch(self, process: Process):
+        self._current = process
+        if process.thread is None:
+            process.thread = threading.Thread(target=self._run_process, args=(process,), daemon=True)
+            process.thread.start()
+        else:
+            process.resumed.release()
+        self._suspended.acquire()
+        self._current = None
+        if process.error is not None:
+            raise process.error
+
+    def _run_process(self, process: Process):
+        try:
+            process.target()
+        except BaseException as e:
+            process.error = e
+        finally:
+            self._suspended.release()
+
+
+class InMemoryResult:
+    """Stands for AsyncResult returned by celery_app.send_task"""
+
+    def __init__(self, clock: VirtualClock, task_id: str, task_name: str):
+        self.id = task_id
+        self.task_name = task_name
+        self._clock = clock
+        self._ready = False
+        self._value = None
+        self._error = None
+        self._waiting = None  # process waiting for the result in get()
+
+    def set(self, value=None, error: Exception = None):
+        self._ready = True
+        self._value = value
+        self._error = error
+        if self._waiting is not None:
+            self._clock.resume_later(self._waiting)
+            self._waiting = None
+
+    def get(self, timeout: float = None):
+        """Like AsyncResult.get(): raises TimeoutError or exception raised by command handler"""
+        if not self._ready:
+            process = self._clock.current
+            self._waiting = process
+            if timeout is not None:
+                self._clock.call_later(timeout, lambda: self._on_timeout(process))
+            self._clock.suspend()
+
+        if not self._ready:
+            error = CeleryTimeoutError('The operation timed out.')
+            self._clock.current.failures[id(error)] = f'timeout on {self.task_name}'
+            raise error
+        if self._error is not None:
+            self._clock.current.failures[id(self._error)] = f'error on {self.task_name}'
+            raise self._error
+        return self._value
+
+    def _on_timeout(self, process: Process):
+        if self._waiting is process:
+            self._waiting = None
+            self._clock.resume_later(process)
+
+
+@dataclasses.dataclass
+class Message:
+    task_name: str
+    args: list
+    headers: dict
+    result: InMemoryResult
+
+
+class Stats:
+    def __init__(self):
+        self.outcomes = Counter()
+        self.compensation_errors = Counter()
+        self.saga_durations = []
+        self.queue_waits = defaultdict(list)
+
+
+class InMemoryBroker:
+    def __init__(self):
+        self.queues: Dict[str, deque] = defaultdict(deque)
+        self._subscribers = defaultdict(list)
+
+    def subscribe(self, queue: str, worker: 'SimulatedWorker'):
+        self._subscribers[queue].append(worker)
+
+    def queue_depth(self, queue: str) -> int:
+        return len(self.queues[queue])
+
+    def publish(self, queue: str, message: Message):
+        self.queues[queue].append(message)
+        # like RabbitMQ, offer messages to consumers of the queue in turn
+        subscribers = self._subscribers[queue]
+        subscribers.append(subscribers.pop(0))
+        for worker in subscribers:
+            worker.poll()
+
+
+class SimulatedWorker:
+    def __init__(self, config: WorkerConfig, simulation: 'Simulation'):
+        self.config = config
+        self.simulation = simulation
+        self.busy = 0
+        self._next_queue = 0
+        for queue in config.queues:
+            simulation.broker.subscribe(queue, self)
+
+    def poll(self):
+        while self.busy < self.config.concurrency:
+            message = self._next_message()
+            if message is None:
+                return
+            self.busy += 1
+            self.simulation.clock.spawn(lambda message=message: self._handle(message))
+
+    def _next_message(self) -> Optional[Message]:
+        queues = self.config.queues
+        for i in range(len(queues)):
+            index = (self._next_queue + i) % len(queues)
+            if self.simulation.broker.queues[queues[index]]:
+                self._next_queue = (index + 1) % len(queues)
+                return self.simulation.broker.queues[queues[index]].popleft()
+        return None
+
+    def _handle(self, message: Message):
+        simulation = self.simulation
+        sent_at = message.headers.get(queue_wait.SENT_AT_HEADER)
+        if sent_at is not None:
+            simulation.stats.queue_waits[message.task_name].append(time.time() - sent_at)
+
+        profile = simulation.profile(message.task_name)
+        time.sleep(profile.latency(simulation.rng))
+        try:
+            if simulation.rng.random() < profile.error_rate:
+                raise InjectedFailure(f'{message.task_name} failed')
+            message.result.set(value=simulation.handlers[message.task_name](*message.args))
+        except Exception as e:
+            message.result.set(error=e)
+
+        self.busy -= 1
+        self.poll()
+
+
+# input data of orders, like in /run-*-saga endpoints of order_service
+
+
+def random_order(rng: random.Random) -> dict:
+    # like /run-random-saga: magic numbers make demo command handlers fail or take 7 seconds
+    return dict(consumer_id=rng.randint(1, 100), price=rng.randint(10, 100), card_id=rng.randint(1, 5))
+
+
+def successful_order(rng: random.Random) -> dict:
+    return dict(consumer_id=app.CONSUMER_ID_THAT_WILL_SUCCEED, price=app.PRICE_THAT_WILL_SUCCEED,
+                card_id=rng.randint(1, 5))
+
+
+def order_failing_card_authorization(probability: float):
+    def order_input(rng: random.Random) -> dict:
+        price = app.PRICE_THAT_WILL_FAIL if rng.random() < probability else app.PRICE_THAT_WILL_SUCCEED
+        return dict(consumer_id=app.CONSUMER_ID_THAT_WILL_SUCCEED, price=price, card_id=rng.randint(1, 5))
+    return order_input
+
+
+class Simulation:
+    def __init__(self,
+                 profiles: Dict[str, TaskProfile],
+                 workers: List[WorkerConfig],
+                 seed: int = 0):
+        self.profiles = profiles
+        self.rng = random.Random(seed)
+        # command handlers use module-level random
+        random.seed(seed)
+        self.clock = VirtualClock()
+        self.broker = InMemoryBroker()
+        self.stats = Stats()
+        self.handlers = command_handlers()
+        self.workers = [SimulatedWorker(config, self) for config in workers]
+        self._task_ids = itertools.count(1)
+        # virtual time.time() starts from real current time
+        self._epoch = time.time()
+
+    def profile(self, task_name: str) -> TaskProfile:
+        return self.profiles.get(task_name) or TaskProfile()
+
+    def send_task(self, name, args=None, kwargs=None, queue=None, headers=None, **options) -> InMemoryResult:
+        """Replaces celery_app.send_task of order_service"""
+        result = InMemoryResult(self.clock, f'simulated-{next(self._task_ids)}', name)
+        self.broker.publish(queue, Message(task_name=name, args=args or [], headers=headers or {}, result=result))
+        return result
+
+    def run(self, sagas: int, rate: float, order_input: Callable[[random.Random], dict]) -> Stats:
+        """Start `sagas` sagas with Poisson arrivals of `rate` sagas per second and run until all finish"""
+        started_at = 0.0
+        for _ in range(sagas):
+            started_at += self.rng.expovariate(rate)
+            input_data = order_input(self.rng)
+            self.clock.spawn(lambda input_data=input_data: self._run_saga(input_data), delay=started_at)
+
+        with self._patched():
+            self.clock.run()
+        return self.stats
+
+    @contextlib.contextmanager
+    def _patched(self):
+        with mock.patch.object(app.celery_app, 'send_task', self.send_task), \
+                mock.patch.object(app.admission_controller, 'queue_depth_fn', self.broker.queue_depth), \
+                mock.patch('time.sleep', self.clock.sleep), \
+                mock.patch('time.monotonic', lambda: self.clock.now), \
+                mock.patch('time.time', lambda: self._epoch + self.clock.now):
+            yield
+
+    def _run_saga(self, input_data: dict):
+        started_at = self.clock.now
+        try:
+            app.run_create_order_saga(dict(items=[app.OrderItem(name='pizza', quantity=1)], **input_data))
+            outcome = 'SUCCEEDED'
+        except AdmissionRejected as e:
+            self.stats.outcomes[f'REJECTED ({e.reason.split(":")[0]})'] += 1
+            return
+        except SagaError as e:
+            outcome = f'FAILED ({self._describe_failure(e.action)})'
+            for error in e.compensations:
+                self.stats.compensation_errors[self._describe_failure(error)] += 1
+        finally:
+            app.db.session.remove()
+
+        self.stats.outcomes[outcome] += 1
+        self.stats.saga_durations.append(self.clock.now - started_at)
+
+    def _describe_failure(self, error: BaseException) -> str:
+        return self.clock.current.failures.get(id(error), f'{type(error).__name__}: {error}')
+
+
+@dataclasses.dataclass
+class Scenario:
+    order_input: Callable[[random.Random], dict]
+    profiles: Dict[str, TaskProfile] = dataclasses.field(default_factory=dict)
+    # new sagas per second
+    rate: float = 50
+    # concurrency of each worker
+    concurrency: int = 100
+
+
+SCENARIOS = {
+    # random input data of /run-random-saga against demo command handlers as they are:
+    #   consumer ids 1-49 fail, ids 50-59 take 7 seconds, prices 50-100 fail card authorization
+    'demo': Scenario(order_input=random_order),
+    # slow consumer verification: some sagas time out
+    'timeouts': Scenario(order_input=successful_order, profiles={
+        verify_consumer_details_message.TASK_NAME: TaskProfile(latency=lognormal(median=2, sigma=0.8)),
+    }, rate=15),
+    # card authorization mostly fails, so almost every saga rejects restaurant ticket
+    #   while restaurant workers are saturated by forward "create ticket" commands.
+    #   Compare queue wait of create_ticket and reject_ticket to see compensations lane at work
+    'compensation-storm': Scenario(order_input=order_failing_card_authorization(0.9), profiles={
+        create_ticket_message.TASK_NAME: TaskProfile(latency=uniform(0.15, 0.3)),
+        authorize_card_message.TASK_NAME: TaskProfile(latency=uniform(0.05, 0.15)),
+        reject_ticket_message.TASK_NAME: TaskProfile(latency=uniform(0.05, 0.2)),
+    }, rate=44, concurrency=10),
+}
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def report(stats: Stats, virtual_time: float, wall_time: float):
+    sagas = sum(stats.outcomes.values())
+    print(f'Sagas: {sagas}, virtual time: {virtual_time:.1f}s, wall time: {wall_time:.2f}s')
+
+    print('Outcomes:')
+    for outcome, count in stats.outcomes.most_common():
+        print(f'  {outcome}: {count} ({count / sagas:.1%})')
+
+    if stats.compensation_errors:
+        print('Compensation errors:')
+        for error, count in stats.compensation_errors.most_common():
+            print(f'  {error}: {count}')
+
+    durations = stats.saga_durations
+    if durations:
+        print(f'Saga duration: median={statistics.median(durations):.2f}s p95={percentile(durations, 0.95):.2f}s '
+              f'p99={percentile(durations, 0.99):.2f}s max={max(durations):.2f}s')
+
+    print('Queue wait:')
+    for task_name, waits in sorted(stats.queue_waits.items()):
+        print(f'  {task_name}: median={statistics.median(waits):.2f}s '
+              f'p95={percentile(waits, 0.95):.2f}s max={max(waits):.2f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=SCENARIOS, default='demo')
+    parser.add_argument('--sagas', type=int, default=1000)
+    parser.add_argument('--rate', type=float, help='new sagas per second. Default depends on scenario')
+    parser.add_argument('--concurrency', type=int, help='concurrency of each worker. Default depends on scenario')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # logs of thousands of sagas would take most of the time
+    logging.disable(logging.CRITICAL)
+
+    scenario = SCENARIOS[args.scenario]
+    simulation = Simulation(profiles=scenario.profiles,
+                            workers=default_workers(args.concurrency or scenario.concurrency),
+                            seed=args.seed)
+    wall_started_at = time.perf_counter()
+    stats = simulation.run(sagas=args.sagas, rate=args.rate or scenario.rate, order_input=scenario.order_input)
+    report(stats, simulation.clock.now, time.perf_counter() - wall_started_at)
+
+
+if __name__ == '__main__':
+    main()
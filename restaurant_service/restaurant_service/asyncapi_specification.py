@@ -8,7 +8,8 @@ from restaurant_service.app_common.messaging.restaurant_service_messaging import
 spec = asyncapi.Specification(
     info=asyncapi.Info(
         title='Restaurant service', version='1.0.0',
-        description=f'Takes command messages from "{restaurant_service_messaging.COMMANDS_QUEUE}" queue',
+        description=f'Takes command messages from "{restaurant_service_messaging.COMMANDS_QUEUE}" queue. \n'
+                    f'Compensation commands are taken from "{restaurant_service_messaging.COMPENSATIONS_QUEUE}" queue',
     ),
     channels=dict([
         message_to_channel(create_ticket_message.message,
@@ -4,8 +4,8 @@ from dataclasses import asdict
 
 from celery import Celery
 
-from restaurant_service.app_common import settings
-from restaurant_service.app_common.messaging import restaurant_service_messaging
+from restaurant_service.app_common import settings, worker_pool
+from restaurant_service.app_common.messaging import restaurant_service_messaging, queue_wait
 from restaurant_service.app_common.messaging.restaurant_service_messaging import \
     create_ticket_message, reject_ticket_message, approve_ticket_message
 
@@ -16,6 +16,14 @@ command_handlers_celery_app = Celery(
     broker=settings.CELERY_BROKER,
     backend=settings.CELERY_RESULT_BACKEND)
 command_handlers_celery_app.conf.task_default_queue = restaurant_service_messaging.COMMANDS_QUEUE
+command_handlers_celery_app.conf.worker_concurrency = settings.CELERY_WORKER_CONCURRENCY
+command_handlers_celery_app.conf.result_expires = settings.CELERY_RESULT_EXPIRES
+worker_pool.check_worker_pool()
+# don't let a worker reserve a big batch of forward commands from the queue:
+#   otherwise compensations arriving later would wait behind that batch
+command_handlers_celery_app.conf.worker_prefetch_multiplier = 1
+
+queue_wait.log_queue_wait()
 
 
 @command_handlers_celery_app.task(name=create_ticket_message.TASK_NAME)